@@ -3,19 +3,29 @@
 extract_sushi.py - Extract sushi restaurants from OSM PBF and output as GeoJSON
 
 Usage:
-    python extract_sushi.py input.osm.pbf output.geojson [--pref PREFECTURE]
+    python extract_sushi.py input.osm.pbf output.geojson [--pref PREFECTURE] [--prefilter]
+                            [--bbox WEST,SOUTH,EAST,NORTH]
 
 Requirements:
     - osmium (Python bindings)
+    - orjson
     - shapely
+    - osmium-tool (only for --prefilter)
 """
 
 import argparse
-import json
+import os
+import queue
+import re
+import shutil
+import subprocess
 import sys
+import threading
+from array import array
 from collections import defaultdict
 from typing import Optional
 
+import orjson
 import osmium
 from shapely.geometry import Point, mapping
 from shapely.ops import unary_union
@@ -72,7 +82,23 @@ PREFECTURE_MAP = {
 }
 
 
-def is_sushi_shop(tags: dict) -> bool:
+# "寿司" in its various written forms; IGNORECASE covers Sushi/SUSHI
+SUSHI_NAME_RE = re.compile("寿司|すし|スシ|鮨|sushi", re.IGNORECASE)
+
+
+def _has_sushi_name(name: Optional[str]) -> bool:
+    """Check for "寿司" in name (various forms)."""
+    return bool(name) and SUSHI_NAME_RE.search(name) is not None
+
+
+def _has_sushi_cuisine(cuisine: Optional[str]) -> bool:
+    """Check for sushi in cuisine (can be comma-separated list)."""
+    # Cuisine values are lowercase by OSM convention, so only build a
+    # lowercased copy when the plain check fails
+    return bool(cuisine) and ("sushi" in cuisine or "sushi" in cuisine.lower())
+
+
+def is_sushi_shop(tags: osmium.osm.TagList) -> bool:
     """
     Check if OSM tags indicate a sushi restaurant.
     
@@ -81,64 +107,120 @@ def is_sushi_shop(tags: dict) -> bool:
     2. amenity=restaurant AND name contains "寿司"
     3. shop=seafood AND name contains "寿司"
     4. amenity=fast_food AND cuisine=sushi
+    
+    Checks are ordered so that the common case (not a restaurant at all)
+    returns before name/cuisine are read.
     """
     amenity = tags.get("amenity", "")
-    shop = tags.get("shop", "")
-    cuisine = tags.get("cuisine", "").lower()
-    name = tags.get("name", "")
     
-    # Check for sushi in cuisine (can be comma-separated list)
-    has_sushi_cuisine = "sushi" in cuisine
+    # Condition 1 / 2: restaurant with sushi cuisine or sushi in name
+    if amenity == "restaurant":
+        if (_has_sushi_cuisine(tags.get("cuisine")) or
+                _has_sushi_name(tags.get("name"))):
+            return True
     
-    # Check for "寿司" in name (various forms)
-    sushi_keywords = ["寿司", "すし", "スシ", "鮨", "sushi"]
-    has_sushi_name = any(kw in name.lower() for kw in sushi_keywords)
-    
-    # Condition 1: restaurant with sushi cuisine
-    if amenity == "restaurant" and has_sushi_cuisine:
-        return True
-    
-    # Condition 2: restaurant with sushi in name
-    if amenity == "restaurant" and has_sushi_name:
-        return True
+    # Condition 4: fast_food with sushi cuisine (conveyor belt sushi, etc.)
+    elif amenity == "fast_food":
+        if _has_sushi_cuisine(tags.get("cuisine")):
+            return True
     
     # Condition 3: seafood shop with sushi in name
-    if shop == "seafood" and has_sushi_name:
-        return True
-    
-    # Condition 4: fast_food with sushi cuisine (conveyor belt sushi, etc.)
-    if amenity == "fast_food" and has_sushi_cuisine:
-        return True
+    if tags.get("shop", "") == "seafood":
+        return _has_sushi_name(tags.get("name"))
     
     return False
 
 
-def matches_prefecture(tags: dict, pref_filter: Optional[str]) -> bool:
-    """Check if the feature matches the prefecture filter."""
-    if pref_filter is None:
+def compile_prefecture_pattern(pref_filter: str) -> re.Pattern:
+    """Compile all names of a prefecture into a single regex."""
+    pref_names = PREFECTURE_MAP.get(pref_filter.lower(), [pref_filter])
+    return re.compile("|".join(re.escape(p) for p in pref_names))
+
+
+def matches_prefecture(tags: osmium.osm.TagList, pref_re: Optional[re.Pattern]) -> bool:
+    """
+    Check if the feature matches the prefecture filter.
+    `pref_re` comes from compile_prefecture_pattern() (None = no filter).
+    """
+    if pref_re is None:
         return True
     
-    pref_names = PREFECTURE_MAP.get(pref_filter.lower(), [pref_filter])
+    # Check addr:prefecture, then addr:full, then addr:city
+    # (addr:city sometimes contains the prefecture)
+    return bool(
+        pref_re.search(tags.get("addr:prefecture", "")) or
+        pref_re.search(tags.get("addr:full", "")) or
+        pref_re.search(tags.get("addr:city", ""))
+    )
+
+
+# Tag filter expressions for osmium tags-filter (same as fetch_and_extract_sushi.ps1)
+PREFILTER_TAGS = [
+    "nwr/amenity=restaurant",
+    "nwr/amenity=fast_food",
+    "nwr/shop=seafood",
+]
+
+
+def prefilter_pbf(input_file: str, output_file: str) -> None:
+    """
+    Reduce the PBF to candidate objects with osmium-tool.
     
-    # Check addr:prefecture
-    addr_pref = tags.get("addr:prefecture", "")
-    if any(p in addr_pref for p in pref_names):
-        return True
+    osmium-tool decodes PBF blocks on all cores, so the Python pass only
+    has to read the (much smaller) filtered file.
+    """
+    osmium_cmd = shutil.which("osmium")
+    if osmium_cmd is None:
+        raise RuntimeError("osmium-tool not found (conda install -c conda-forge osmium-tool)")
+    
+    subprocess.run(
+        [osmium_cmd, "tags-filter", input_file, "-o", output_file, "--overwrite"]
+        + PREFILTER_TAGS,
+        check=True
+    )
+
+
+class SushiProperties:
+    """
+    Properties of one sushi feature.
     
-    # Check addr:full for prefecture name
-    addr_full = tags.get("addr:full", "")
-    if any(p in addr_full for p in pref_names):
-        return True
+    Uses __slots__ instead of a per-feature dict; as_dict() builds the
+    GeoJSON properties only when the feature is written.
+    """
     
-    # Check addr:city (sometimes contains prefecture)
-    addr_city = tags.get("addr:city", "")
-    if any(p in addr_city for p in pref_names):
-        return True
+    __slots__ = (
+        "osm_id", "name", "name_reading", "amenity", "shop", "cuisine",
+        "prefecture", "city", "full",
+    )
     
-    return False
+    def __init__(self, osm_id: str, name: str, name_reading: str, amenity: str,
+                 shop: str, cuisine: str, prefecture: str, city: str, full: str):
+        self.osm_id = osm_id
+        self.name = name
+        self.name_reading = name_reading  # ひらがな/カタカナ/ローマ字の読み
+        self.amenity = amenity
+        self.shop = shop
+        self.cuisine = cuisine
+        self.prefecture = prefecture
+        self.city = city
+        self.full = full
+    
+    def as_dict(self) -> dict:
+        return {
+            "osm_id": self.osm_id,
+            "name": self.name,
+            "name_reading": self.name_reading,
+            "amenity": self.amenity,
+            "shop": self.shop,
+            "cuisine": self.cuisine,
+            "addr:prefecture": self.prefecture,
+            "addr:city": self.city,
+            "addr:full": self.full,
+            "source": "OSM"
+        }
 
 
-def extract_properties(osm_id: str, tags: dict) -> dict:
+def extract_properties(osm_id: str, tags: osmium.osm.TagList) -> SushiProperties:
     """Extract required properties from OSM tags."""
     # Try to get reading/hiragana name for sorting
     # OSM uses various tags: name:ja_rm (romanized), name:ja-Hira (hiragana), 
@@ -151,146 +233,230 @@ def extract_properties(osm_id: str, tags: dict) -> dict:
         ""
     )
     
+    return SushiProperties(
+        osm_id=osm_id,
+        name=tags.get("name", ""),
+        name_reading=name_reading,
+        amenity=tags.get("amenity", ""),
+        shop=tags.get("shop", ""),
+        cuisine=tags.get("cuisine", ""),
+        prefecture=tags.get("addr:prefecture", ""),
+        city=tags.get("addr:city", ""),
+        full=tags.get("addr:full", ""),
+    )
+
+
+def parse_bbox(value: str) -> tuple:
+    """Parse a "west,south,east,north" bounding box argument."""
+    try:
+        west, south, east, north = (float(v) for v in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"bbox must be WEST,SOUTH,EAST,NORTH (got {value!r})"
+        )
+    if west > east or south > north:
+        raise argparse.ArgumentTypeError(
+            f"bbox needs west <= east and south <= north (got {value!r})"
+        )
+    return (west, south, east, north)
+
+
+def dedup_key(lon: float, lat: float, name: str) -> tuple:
+    """
+    Key used to drop duplicate features (same coordinates and name).
+    Coordinates are rounded to ~1m (1e-5 degree) precision as integers,
+    which hash faster than rounded floats.
+    """
+    return (round(lon * 100000), round(lat * 100000), name)
+
+
+def make_feature(lon: float, lat: float, properties: dict) -> dict:
+    """Build a GeoJSON Point feature."""
     return {
-        "osm_id": osm_id,
-        "name": tags.get("name", ""),
-        "name_reading": name_reading,  # ひらがな/カタカナ/ローマ字の読み
-        "amenity": tags.get("amenity", ""),
-        "shop": tags.get("shop", ""),
-        "cuisine": tags.get("cuisine", ""),
-        "addr:prefecture": tags.get("addr:prefecture", ""),
-        "addr:city": tags.get("addr:city", ""),
-        "addr:full": tags.get("addr:full", ""),
-        "source": "OSM"
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [lon, lat]
+        },
+        "properties": properties
     }
 
 
-class NodeCollector(osmium.SimpleHandler):
-    """First pass: collect node coordinates for way/relation centroid calculation."""
+class SushiExtractor(osmium.SimpleHandler):
+    """
+    Extract sushi restaurants in a single pass over the PBF.
     
-    def __init__(self):
-        super().__init__()
-        self.node_coords = {}
+    Features are written to `out` (a binary file) in batches of
+    BATCH_SIZE, so the whole FeatureCollection is never held in memory.
+    Pending features are kept as parallel arrays (coordinates in
+    array('d'), SushiProperties records) and only turned into GeoJSON
+    dicts when the batch is written.
     
-    def node(self, n):
-        if n.location.valid():
-            self.node_coords[n.id] = (n.location.lon, n.location.lat)
-
-
-class SushiExtractor(osmium.SimpleHandler):
-    """Second pass: extract sushi restaurants."""
+    Serialization and writing run on a background thread fed through a
+    bounded queue, so they overlap with PBF parsing. Call close() after
+    processing to drain the queue and terminate the GeoJSON.
+    """
     
-    def __init__(self, node_coords: dict, pref_filter: Optional[str] = None):
+    BATCH_SIZE = 4096
+    QUEUE_SIZE = 4  # Batches in flight before the handler blocks
+    
+    def __init__(self, out, node_locations, pref_filter: Optional[str] = None,
+                 dedup: bool = True, bbox: Optional[tuple] = None):
         super().__init__()
-        self.node_coords = node_coords
-        self.pref_filter = pref_filter
-        self.features = []
-        self.way_nodes = {}  # Store way node refs for centroid calculation
+        self.out = out
+        self.node_locations = node_locations  # osmium location index
+        # Compiled once here rather than looked up per object
+        self.pref_re = compile_prefecture_pattern(pref_filter) if pref_filter else None
+        self.seen = set() if dedup else None
+        self.bbox = bbox  # (west, south, east, north) or None
+        self.found = 0
+        self.written = 0
+        
+        # Pending batch (structure of arrays)
+        self.lons = array("d")
+        self.lats = array("d")
+        self.properties = []
+        
+        self.out.write(b'{"type":"FeatureCollection","features":[')
+        
+        self.batches = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.writer_error = None
+        self.writer = threading.Thread(target=self._write_batches, daemon=True)
+        self.writer.start()
+    
+    def _write_batches(self):
+        """Writer thread: serialize queued batches until the None sentinel."""
+        first = True
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.writer_error is not None:
+                continue  # Keep draining so the handler never blocks
+            
+            lons, lats, properties = batch
+            try:
+                chunk = b",".join(
+                    orjson.dumps(make_feature(lon, lat, p.as_dict()))
+                    for lon, lat, p in zip(lons, lats, properties)
+                )
+                if not first:
+                    self.out.write(b",")
+                self.out.write(chunk)
+                first = False
+            except Exception as e:
+                self.writer_error = e
+    
+    def flush(self):
+        """Hand the pending batch to the writer thread."""
+        if self.writer_error is not None:
+            raise self.writer_error
+        if not self.properties:
+            return
+        
+        self.batches.put((self.lons, self.lats, self.properties))
+        self.written += len(self.properties)
+        
+        self.lons = array("d")
+        self.lats = array("d")
+        self.properties = []
+    
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+        if self.writer_error is not None:
+            raise self.writer_error
+        self.out.write(b"]}\n")
+    
+    def emit(self, osm_id: str, lon: float, lat: float, tags: osmium.osm.TagList):
+        """Queue one feature for writing, skipping duplicates."""
+        if self.bbox is not None:
+            west, south, east, north = self.bbox
+            if not (west <= lon <= east and south <= lat <= north):
+                return
+        
+        self.found += 1
+        properties = extract_properties(osm_id, tags)
+        
+        if self.seen is not None:
+            key = dedup_key(lon, lat, properties.name)
+            if key in self.seen:
+                return
+            self.seen.add(key)
+        
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.properties.append(properties)
+        if len(self.properties) >= self.BATCH_SIZE:
+            self.flush()
     
     def node(self, n):
-        if not n.location.valid():
+        # Most OSM objects (way vertices above all) carry no tags at all.
+        # The TagList length check runs in C++, so those are rejected
+        # without entering the Python-level filters.
+        tags = n.tags
+        if not tags or not is_sushi_shop(tags):
             return
         
-        tags = dict(n.tags)
-        if not is_sushi_shop(tags):
+        if not n.location.valid():
             return
         
-        if not matches_prefecture(tags, self.pref_filter):
+        if not matches_prefecture(tags, self.pref_re):
             return
         
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [n.location.lon, n.location.lat]
-            },
-            "properties": extract_properties(f"node/{n.id}", tags)
-        }
-        self.features.append(feature)
+        self.emit(f"node/{n.id}", n.location.lon, n.location.lat, tags)
     
     def way(self, w):
-        tags = dict(w.tags)
-        if not is_sushi_shop(tags):
+        tags = w.tags
+        if not tags or not is_sushi_shop(tags):
             return
         
-        if not matches_prefecture(tags, self.pref_filter):
+        if not matches_prefecture(tags, self.pref_re):
             return
         
-        # Calculate centroid from way nodes
-        coords = []
+        # Calculate centroid from way nodes (locations filled in by
+        # NodeLocationsForWays), summing in one pass
+        sum_lon = sum_lat = 0.0
+        count = 0
         for node_ref in w.nodes:
-            if node_ref.ref in self.node_coords:
-                coords.append(self.node_coords[node_ref.ref])
+            location = node_ref.location
+            if location.valid():
+                sum_lon += location.lon
+                sum_lat += location.lat
+                count += 1
         
-        if not coords:
+        if not count:
             return
         
-        # Calculate centroid
-        lon = sum(c[0] for c in coords) / len(coords)
-        lat = sum(c[1] for c in coords) / len(coords)
-        
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [lon, lat]
-            },
-            "properties": extract_properties(f"way/{w.id}", tags)
-        }
-        self.features.append(feature)
+        self.emit(f"way/{w.id}", sum_lon / count, sum_lat / count, tags)
     
     def relation(self, r):
-        tags = dict(r.tags)
-        if not is_sushi_shop(tags):
+        tags = r.tags
+        if not tags or not is_sushi_shop(tags):
             return
         
-        if not matches_prefecture(tags, self.pref_filter):
+        if not matches_prefecture(tags, self.pref_re):
             return
         
-        # Collect coordinates from member nodes/ways
-        coords = []
+        # Calculate centroid from member nodes, summing in one pass
+        sum_lon = sum_lat = 0.0
+        count = 0
         for member in r.members:
-            if member.type == 'n' and member.ref in self.node_coords:
-                coords.append(self.node_coords[member.ref])
+            if member.type != 'n':
+                continue
+            try:
+                location = self.node_locations.get(member.ref)
+            except KeyError:
+                continue
+            sum_lon += location.lon
+            sum_lat += location.lat
+            count += 1
         
-        if not coords:
+        if not count:
             return
         
-        # Calculate centroid
-        lon = sum(c[0] for c in coords) / len(coords)
-        lat = sum(c[1] for c in coords) / len(coords)
-        
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [lon, lat]
-            },
-            "properties": extract_properties(f"relation/{r.id}", tags)
-        }
-        self.features.append(feature)
-
-
-def deduplicate_features(features: list) -> list:
-    """
-    Remove duplicate features based on same coordinates and name.
-    Uses (rounded coordinates + name) as key.
-    """
-    seen = set()
-    unique_features = []
-    
-    for feature in features:
-        coords = feature["geometry"]["coordinates"]
-        name = feature["properties"]["name"]
-        
-        # Round coordinates to ~1m precision for deduplication
-        key = (round(coords[0], 5), round(coords[1], 5), name)
-        
-        if key not in seen:
-            seen.add(key)
-            unique_features.append(feature)
-    
-    return unique_features
+        self.emit(f"relation/{r.id}", sum_lon / count, sum_lat / count, tags)
 
 
 def main():
@@ -309,44 +475,76 @@ def main():
         action="store_true",
         help="Disable deduplication"
     )
+    parser.add_argument(
+        "--bbox",
+        type=parse_bbox,
+        default=None,
+        metavar="WEST,SOUTH,EAST,NORTH",
+        help="Only keep features inside this bounding box (e.g., 139.50,35.53,139.91,35.82)"
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="Filter the PBF with osmium-tool before extraction (multi-threaded)"
+    )
     
     args = parser.parse_args()
     
     print(f"Processing: {args.input}")
     if args.pref:
         print(f"Prefecture filter: {args.pref}")
-    
-    # First pass: collect node coordinates
-    print("Pass 1: Collecting node coordinates...")
-    node_collector = NodeCollector()
-    node_collector.apply_file(args.input, locations=True)
-    print(f"  Collected {len(node_collector.node_coords):,} node coordinates")
-    
-    # Second pass: extract sushi restaurants
-    print("Pass 2: Extracting sushi restaurants...")
-    extractor = SushiExtractor(node_collector.node_coords, args.pref)
-    extractor.apply_file(args.input, locations=True)
-    
-    features = extractor.features
-    print(f"  Found {len(features):,} sushi restaurants")
-    
-    # Deduplicate
-    if not args.no_dedup:
-        features = deduplicate_features(features)
-        print(f"  After deduplication: {len(features):,} features")
-    
-    # Create GeoJSON
-    geojson = {
-        "type": "FeatureCollection",
-        "features": features
-    }
-    
-    # Write output
-    with open(args.output, "w", encoding="utf-8") as f:
-        json.dump(geojson, f, ensure_ascii=False, indent=2)
-    
-    print(f"\nOutput written to: {args.output}")
-    print(f"Total features: {len(features):,}")
+    if args.bbox:
+        print(f"Bounding box: {args.bbox}")
+    
+    input_file = args.input
+    filtered_file = args.output + ".filtered.osm.pbf" if args.prefilter else None
+    index_file = args.output + ".nodes.idx"
+    # Stream into a temp file so a failed run never clobbers an existing output
+    tmp_output = args.output + ".tmp"
+    
+    extractor = None
+    reader = None
+    node_locations = location_handler = None
+    try:
+        if filtered_file:
+            print("Prefiltering with osmium tags-filter...")
+            prefilter_pbf(args.input, filtered_file)
+            input_file = filtered_file
+        
+        # Node locations are kept in a file-backed index instead of a Python
+        # dict, so memory stays flat even for the full Japan PBF
+        node_locations = osmium.index.create_map(f"sparse_file_array,{index_file}")
+        location_handler = osmium.NodeLocationsForWays(node_locations)
+        location_handler.ignore_errors()
+        
+        print("Extracting sushi restaurants...")
+        reader = osmium.io.Reader(input_file)
+        with open(tmp_output, "wb") as out:
+            extractor = SushiExtractor(
+                out, node_locations, args.pref,
+                dedup=not args.no_dedup, bbox=args.bbox
+            )
+            osmium.apply(reader, location_handler, extractor)
+            extractor.close()
+        os.replace(tmp_output, args.output)
+        
+        print(f"  Found {extractor.found:,} sushi restaurants")
+        if not args.no_dedup:
+            print(f"  After deduplication: {extractor.written:,} features")
+        
+        print(f"\nOutput written to: {args.output}")
+        print(f"Total features: {extractor.written:,}")
+    finally:
+        if reader is not None:
+            reader.close()
+        # Release the index before deleting its backing file
+        del extractor, location_handler, node_locations
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        if filtered_file and os.path.exists(filtered_file):
+            os.remove(filtered_file)
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
     
     return 0
 
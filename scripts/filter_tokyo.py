@@ -3,9 +3,11 @@
 Filter sushi GeoJSON data for Tokyo area only.
 """
 
-import json
 import sys
 
+import numpy as np
+import orjson
+
 # Tokyo bounds (from city config)
 TOKYO_BOUNDS = {
     "north": 35.82,
@@ -19,21 +21,24 @@ def main():
     output_file = "data/out/sushi_tokyo_filtered.geojson"
     
     print(f"Reading: {input_file}")
-    with open(input_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    with open(input_file, "rb") as f:
+        data = orjson.loads(f.read())
     
     original_count = len(data["features"])
     print(f"Original features: {original_count}")
     
-    # Filter for Tokyo bounds
-    tokyo_features = []
-    for feature in data["features"]:
-        coords = feature["geometry"]["coordinates"]
-        lon, lat = coords[0], coords[1]
-        
-        if (TOKYO_BOUNDS["west"] <= lon <= TOKYO_BOUNDS["east"] and
-            TOKYO_BOUNDS["south"] <= lat <= TOKYO_BOUNDS["north"]):
-            tokyo_features.append(feature)
+    # Filter for Tokyo bounds (vectorized over all points at once)
+    features = data["features"]
+    coords = np.fromiter(
+        (c for feature in features for c in feature["geometry"]["coordinates"][:2]),
+        dtype=np.float64,
+        count=2 * len(features)
+    ).reshape(-1, 2)
+    lon, lat = coords[:, 0], coords[:, 1]
+    
+    mask = ((lon >= TOKYO_BOUNDS["west"]) & (lon <= TOKYO_BOUNDS["east"]) &
+            (lat >= TOKYO_BOUNDS["south"]) & (lat <= TOKYO_BOUNDS["north"]))
+    tokyo_features = [features[i] for i in np.flatnonzero(mask)]
     
     print(f"Tokyo features: {len(tokyo_features)}")
     
@@ -43,8 +48,9 @@ def main():
         "features": tokyo_features
     }
     
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(tokyo_data, f, ensure_ascii=False, indent=2)
+    # orjson always writes UTF-8 (no ensure_ascii) and compact by default
+    with open(output_file, "wb") as f:
+        f.write(orjson.dumps(tokyo_data))
     
     print(f"Output: {output_file}")
     return 0